@@ -1,8 +1,13 @@
+import heapq
 import json
 import os
+import shutil
+import sys
+import threading
 import time
-from datetime import date, datetime
-from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
 import altair as alt
 import pandas as pd
@@ -13,28 +18,635 @@ APP_TITLE_LINE_1 = "Tiêu chí Chất lượng cơ bản"
 APP_TITLE_LINE_2 = "Bệnh viện Sức khỏe Tâm thần BR-VT"
 
 DATA_PATH = os.path.join(os.path.dirname(__file__), "data.json")
+# Dữ liệu được chia theo quý: data/records_<năm>-Q<quý>.json
+# Kỳ đã đóng được niêm phong kèm số liệu tổng hợp sẵn trong data/summaries.json
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+SUMMARIES_PATH = os.path.join(DATA_DIR, "summaries.json")
+# Lịch sử chỉnh sửa chia theo quý ghi nhận: data/history/history_<năm>-Q<quý>.jsonl.
+# Mỗi dòng là một lần sửa, chỉ lưu các trường thay đổi; lần đầu phiếu xuất hiện trong
+# quý và cứ CHECKPOINT_EVERY lần sửa thì lưu lại toàn bộ phiếu làm mốc
+HISTORY_DIR = os.path.join(DATA_DIR, "history")
+CHECKPOINT_EVERY = 10
+
+EVAL_MODES = {"tochuc", "ksnk", "duoc", "kehoach"}
+# Kỳ cố định cho phiếu không có ngày hợp lệ (cả "date" lẫn "createdAt"),
+# để phiếu không bị chuyển sang kỳ khác khi sang quý mới
+LEGACY_PARTITION = "0001-Q1"
+
+# Giới hạn bộ nhớ cho cache kết quả lọc (dùng chung giữa các phiên)
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Đặt APP_DEBUG=1 để hiện thông tin gỡ lỗi (ví dụ: số lần trúng/trượt cache)
+DEBUG = os.environ.get("APP_DEBUG") == "1"
+# Số phiếu tối đa hiển thị trong ô "Chọn phiếu"
+PICKER_LIMIT = 50
+
+_CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+# Các kỳ đã nạp trong phiên → (mtime_ns, size) của file tại lúc phiên đọc/ghi nó
+PartitionVersions = Dict[str, Tuple[int, int]]
 
 
 def _now_iso() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
 
-def load_data() -> List[Dict[str, Any]]:
-    if not os.path.exists(DATA_PATH):
+def _read_json(path: str, default: Any) -> Any:
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        if isinstance(raw, type(default)):
+            return raw
+    except Exception:
+        pass
+    return default
+
+
+def _write_json(path: str, value: Any) -> Tuple[int, int]:
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False, indent=2)
+    info = os.stat(tmp)
+    os.replace(tmp, path)
+    return info.st_mtime_ns, info.st_size
+
+
+def record_day(record: Dict[str, Any]) -> str:
+    return record.get("date") or (record.get("createdAt") or "")[:10]
+
+
+def partition_key_for_date(d: date) -> str:
+    return f"{d.year}-Q{(d.month - 1) // 3 + 1}"
+
+
+def partition_key(record: Dict[str, Any]) -> str:
+    # Không dùng ngày hiện tại làm mặc định: kỳ của phiếu phải cố định theo thời gian
+    for value in (record.get("date"), (record.get("createdAt") or "")[:10]):
+        try:
+            return partition_key_for_date(date.fromisoformat(value))
+        except Exception:
+            continue
+    return LEGACY_PARTITION
+
+
+def partition_bounds(pkey: str) -> Tuple[date, date]:
+    year, quarter = (int(x) for x in pkey.split("-Q"))
+    start = date(year, 3 * (quarter - 1) + 1, 1)
+    end = date(year + 1, 1, 1) if quarter == 4 else date(year, 3 * quarter + 1, 1)
+    return start, end - timedelta(days=1)
+
+
+def active_partition_key() -> str:
+    return partition_key_for_date(date.today())
+
+
+def _partition_path(pkey: str) -> str:
+    return os.path.join(DATA_DIR, f"records_{pkey}.json")
+
+
+def list_partitions() -> List[str]:
+    if not os.path.isdir(DATA_DIR):
         return []
+    keys = []
+    for name in os.listdir(DATA_DIR):
+        if not (name.startswith("records_") and name.endswith(".json")):
+            continue
+        pkey = name[len("records_"):-len(".json")]
+        try:
+            partition_bounds(pkey)
+        except Exception:
+            continue
+        keys.append(pkey)
+    return sorted(keys)
+
+
+def live_partitions() -> List[str]:
+    # Kỳ hiện tại và các kỳ sau (phiếu ghi ngày tương lai) luôn được nạp
+    active = active_partition_key()
+    return [active] + [k for k in list_partitions() if k > active]
+
+
+def partitions_in_range(date_from: date, date_to: date) -> List[str]:
+    out = []
+    for pkey in list_partitions():
+        start, end = partition_bounds(pkey)
+        if start <= date_to and end >= date_from:
+            out.append(pkey)
+    return out
+
+
+def group_by_partition(records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        groups.setdefault(partition_key(r), []).append(r)
+    return groups
+
+
+class IdAllocator:
+    """Cấp id kiểu ULID: 48 bit thời gian (ms) + 80 bit ngẫu nhiên.
+
+    Trong cùng tiến trình id tăng dần kể cả khi nhiều phiếu lưu cùng một ms;
+    giữa các tiến trình, 80 bit ngẫu nhiên tránh trùng mà không cần khóa file.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._last_rand = 0
+
+    def new_id(self) -> str:
+        with self._lock:
+            ms = int(time.time() * 1000)
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                rand = self._last_rand + 1
+                if rand >= 1 << 80:
+                    ms, rand = ms + 1, 0
+            else:
+                rand = int.from_bytes(os.urandom(10), "big")
+            self._last_ms, self._last_rand = ms, rand
+        value = (ms << 80) | rand
+        return "".join(_CROCKFORD[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+@st.cache_resource
+def id_allocator() -> IdAllocator:
+    return IdAllocator()
+
+
+def new_record_id() -> str:
+    return id_allocator().new_id()
+
+
+def _record_label(r: Dict[str, Any]) -> str:
+    return f"{mode_label(r['mode'])} | {get_chuc_danh(r) or '-'} | {r.get('date','-')} | ID {r['id']}"
+
+
+class RecordStore:
+    """Các phiếu đã nạp trong phiên, có chỉ mục theo id và theo kỳ lưu trữ.
+
+    Danh sách phiếu đánh giá, nhãn và khóa tìm kiếm cho ô "Chọn phiếu" được cập nhật
+    tại chỗ khi thêm/sửa/xóa, nên mỗi thao tác chỉ tốn O(1) trong bộ nhớ.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]]) -> None:
+        self._by_id: Dict[Any, Dict[str, Any]] = {}
+        self._by_partition: Dict[str, Dict[Any, Dict[str, Any]]] = {}
+        # Phiếu đánh giá không theo thứ tự; xóa bằng cách đổi chỗ với phần tử cuối
+        self._eval: List[Dict[str, Any]] = []
+        self._eval_pos: Dict[Any, int] = {}
+        self._labels: Dict[Any, str] = {}
+        self._search_keys: Dict[Any, str] = {}
+        self.extend(records)
+
+    def get(self, rid: Any) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(rid)
+
+    def partition(self, pkey: str) -> List[Dict[str, Any]]:
+        return list(self._by_partition.get(pkey, {}).values())
+
+    def upsert(self, rec: Dict[str, Any]) -> None:
+        self._remove(rec.get("id"))
+        self._add(rec)
+
+    def delete(self, rid: Any) -> None:
+        self._remove(rid)
+
+    def extend(self, records: List[Dict[str, Any]]) -> None:
+        # Phiếu đã có trong phiên (có thể đang được sửa) được giữ nguyên
+        for r in records:
+            if r.get("id") not in self._by_id:
+                self._add(r)
+
+    def eval_records(self) -> List[Dict[str, Any]]:
+        # Danh sách dùng chung với store: không được sửa
+        return self._eval
+
+    def labels(self) -> Dict[Any, str]:
+        return self._labels
+
+    def search_labels(self, query: str, limit: int) -> List[Any]:
+        # Chỉ sắp xếp (mới nhất trước) phần kết quả được hiển thị
+        q = (query or "").strip().lower()
+        ids = self._search_keys.keys() if not q else [rid for rid, key in self._search_keys.items() if q in key]
+        return heapq.nlargest(limit, ids, key=lambda rid: (record_day(self._by_id[rid]), str(rid)))
+
+    def _add(self, rec: Dict[str, Any]) -> None:
+        rid = rec.get("id")
+        self._by_id[rid] = rec
+        self._by_partition.setdefault(partition_key(rec), {})[rid] = rec
+        if rec.get("mode") in EVAL_MODES:
+            self._eval_pos[rid] = len(self._eval)
+            self._eval.append(rec)
+            label = _record_label(rec)
+            self._labels[rid] = label
+            self._search_keys[rid] = label.lower()
+
+    def _remove(self, rid: Any) -> None:
+        old = self._by_id.pop(rid, None)
+        if old is None:
+            return
+        self._by_partition.get(partition_key(old), {}).pop(rid, None)
+        pos = self._eval_pos.pop(rid, None)
+        if pos is not None:
+            last = self._eval.pop()
+            if pos < len(self._eval):
+                self._eval[pos] = last
+                self._eval_pos[last.get("id")] = pos
+            self._labels.pop(rid, None)
+            self._search_keys.pop(rid, None)
+
+
+def read_partition(pkey: str) -> Tuple[List[Dict[str, Any]], Tuple[int, int]]:
+    # Phiên bản lấy từ chính file đã mở: file được thay bằng os.replace nên không lệch nội dung
+    path = _partition_path(pkey)
+    if not os.path.exists(path):
+        return [], (0, 0)
     try:
-        with open(DATA_PATH, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
+            info = os.fstat(f.fileno())
             raw = json.load(f)
         if isinstance(raw, list):
-            return raw
+            return raw, (info.st_mtime_ns, info.st_size)
     except Exception:
         pass
-    return []
+    return [], (0, 0)
+
+
+def load_partition(pkey: str) -> List[Dict[str, Any]]:
+    return read_partition(pkey)[0]
+
+
+def save_partition(pkey: str, records: List[Dict[str, Any]]) -> Tuple[int, int]:
+    path = _partition_path(pkey)
+    if records:
+        return _write_json(path, records)
+    if os.path.exists(path):
+        os.remove(path)
+    return 0, 0
+
+
+def load_summaries() -> Dict[str, Dict[str, Any]]:
+    return _read_json(SUMMARIES_PATH, {})
+
+
+def summarize_partition(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    eval_records = [r for r in records if r.get("mode") in EVAL_MODES]
+    by_section, by_type, totals = compute_stats(eval_records)
+    return {
+        "count": len(eval_records),
+        "by_section": by_section,
+        "by_type": by_type,
+        "totals": totals,
+        "sealedAt": _now_iso(),
+    }
+
+
+def _migrate_legacy_data() -> None:
+    # Dữ liệu cũ nằm chung trong data.json: chia sang các phân vùng, giữ bản sao .bak
+    legacy = _read_json(DATA_PATH, [])
+    if not legacy:
+        return
+    for pkey, recs in group_by_partition(legacy).items():
+        existing = load_partition(pkey)
+        ids = {r.get("id") for r in recs}
+        save_partition(pkey, [r for r in existing if r.get("id") not in ids] + recs)
+    if os.path.isdir(HISTORY_DIR):
+        write_baselines(legacy)
+    shutil.copyfile(DATA_PATH, f"{DATA_PATH}.bak")
+    _write_json(DATA_PATH, [])
+
+
+def seal_closed_partitions() -> None:
+    active = active_partition_key()
+    summaries = load_summaries()
+    changed = False
+    for pkey in list_partitions():
+        if pkey < active and pkey not in summaries:
+            summaries[pkey] = summarize_partition(load_partition(pkey))
+            changed = True
+    if changed:
+        _write_json(SUMMARIES_PATH, summaries)
+
+
+def load_data(partitions: List[str], loaded: PartitionVersions) -> List[Dict[str, Any]]:
+    records: List[Dict[str, Any]] = []
+    for pkey in partitions:
+        recs, loaded[pkey] = read_partition(pkey)
+        records.extend(recs)
+    return records
+
+
+def load_live_data() -> Tuple[RecordStore, PartitionVersions]:
+    _migrate_legacy_data()
+    _init_history()
+    seal_closed_partitions()
+    loaded: PartitionVersions = {}
+    store = RecordStore(load_data(live_partitions(), loaded))
+    return store, loaded
+
+
+def ensure_partitions_loaded(store: RecordStore, loaded: PartitionVersions, wanted: List[str]) -> None:
+    missing = [k for k in wanted if k not in loaded]
+    if missing:
+        store.extend(load_data(missing, loaded))
+
+
+def save_data(store: RecordStore, loaded: PartitionVersions, touched: Set[str]) -> None:
+    # Chỉ ghi lại (và cập nhật phiên bản) các kỳ có phiếu thay đổi; các kỳ khác giữ
+    # nguyên phiên bản đã đọc để khóa cache vẫn khớp với dữ liệu trong phiên
+    partitions = sorted(touched)
+    # Phiếu đổi ngày sang kỳ chưa nạp: nạp kỳ đó trước để không ghi đè dữ liệu trên đĩa
+    ensure_partitions_loaded(store, loaded, partitions)
+    for pkey in partitions:
+        loaded[pkey] = save_partition(pkey, store.partition(pkey))
+
+    # Kỳ đã đóng được sửa lại: tính lại số liệu niêm phong
+    closed = [k for k in partitions if k < active_partition_key()]
+    if closed:
+        summaries = load_summaries()
+        for pkey in closed:
+            recs = store.partition(pkey)
+            if recs:
+                summaries[pkey] = summarize_partition(recs)
+            else:
+                summaries.pop(pkey, None)
+        _write_json(SUMMARIES_PATH, summaries)
+
+
+def _history_path(pkey: str) -> str:
+    return os.path.join(HISTORY_DIR, f"history_{pkey}.jsonl")
+
+
+def list_history_shards() -> List[str]:
+    if not os.path.isdir(HISTORY_DIR):
+        return []
+    keys = []
+    for name in os.listdir(HISTORY_DIR):
+        if name.startswith("history_") and name.endswith(".jsonl"):
+            keys.append(name[len("history_"):-len(".jsonl")])
+    return sorted(keys)
+
+
+def _append_history(pkey: str, events: List[Dict[str, Any]]) -> None:
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with open(_history_path(pkey), "a", encoding="utf-8") as f:
+        for ev in events:
+            f.write(json.dumps(ev, ensure_ascii=False) + "\n")
+
+
+def record_delta(old: Dict[str, Any], new: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    changed = {k: v for k, v in new.items() if old.get(k) != v}
+    removed = [k for k in old if k not in new]
+    return changed, removed
+
+
+def _apply_event(state: Optional[Dict[str, Any]], ev: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if "state" in ev:
+        return dict(ev["state"])
+    if ev.get("deleted"):
+        return None
+    out = dict(state or {})
+    out.update(ev.get("set", {}))
+    for k in ev.get("unset", []):
+        out.pop(k, None)
+    return out
+
+
+class HistoryShard:
+    """Lịch sử của một quý, kèm trạng thái mới nhất của từng phiếu trong quý đó.
+
+    Chỉ mục được cập nhật bằng cách đọc phần mới ghi thêm vào cuối file (kể cả
+    từ tiến trình khác), nên mỗi lần ghi không phải đọc lại toàn bộ lịch sử.
+    """
+
+    def __init__(self, pkey: str) -> None:
+        self.pkey = pkey
+        self.path = _history_path(pkey)
+        self._offset = 0
+        # id → (trạng thái mới nhất, số lần sửa kể từ mốc đầy đủ gần nhất)
+        self._heads: Dict[Any, Tuple[Optional[Dict[str, Any]], int]] = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> None:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < self._offset:
+            self._offset = 0
+            self._heads = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # dòng đang được ghi dở
+                self._offset += len(line)
+                try:
+                    ev = json.loads(line)
+                except Exception:
+                    continue
+                if ev.get("purge"):
+                    self._heads.clear()
+                    continue
+                state, since = self._heads.get(ev.get("id"), (None, 0))
+                self._heads[ev.get("id")] = (_apply_event(state, ev), 0 if "state" in ev else since + 1)
 
+    def _write(self, ev: Dict[str, Any]) -> None:
+        _append_history(self.pkey, [ev])
+        self._refresh()
 
-def save_data(records: List[Dict[str, Any]]) -> None:
-    with open(DATA_PATH, "w", encoding="utf-8") as f:
-        json.dump(records, f, ensure_ascii=False, indent=2)
+    def append_revision(self, old: Optional[Dict[str, Any]], new: Dict[str, Any], editor: str) -> None:
+        rid = new.get("id")
+        with self._lock:
+            self._refresh()
+            head, since = self._heads.get(rid, (None, 0))
+            latest = head if head is not None else old
+            if latest is not None and new == latest:
+                return
+            ev: Dict[str, Any] = {"id": rid, "at": _now_iso(), "by": editor}
+            # Lưu mốc đầy đủ khi phiếu chưa có trong quý này, khi bản phiên đang giữ
+            # khác bản mới nhất trong lịch sử (người khác vừa sửa), hoặc đã đủ số lần sửa
+            if head is None or head != old or since + 1 >= CHECKPOINT_EVERY:
+                ev["state"] = new
+            else:
+                changed, removed = record_delta(head, new)
+                ev["set"] = changed
+                if removed:
+                    ev["unset"] = removed
+            self._write(ev)
+
+    def append_deletion(self, rid: Any) -> None:
+        with self._lock:
+            self._write({"id": rid, "at": _now_iso(), "deleted": True})
+
+    def append_purge(self) -> None:
+        with self._lock:
+            self._write({"purge": True, "at": _now_iso()})
+
+
+@st.cache_resource(max_entries=2)
+def history_shard(pkey: str) -> HistoryShard:
+    return HistoryShard(pkey)
+
+
+def append_revision(old: Optional[Dict[str, Any]], new: Dict[str, Any], editor: str) -> None:
+    history_shard(active_partition_key()).append_revision(old, new, editor)
+
+
+def append_deletion(record: Dict[str, Any]) -> None:
+    history_shard(active_partition_key()).append_deletion(record.get("id"))
+
+
+def append_purge() -> None:
+    history_shard(active_partition_key()).append_purge()
+
+
+def write_baselines(records: List[Dict[str, Any]]) -> None:
+    # Trạng thái hiện có của phiếu làm mốc, ghi vào quý của ngày tạo phiếu
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        at = r.get("createdAt") or (f"{r['date']}T00:00:00" if r.get("date") else _now_iso())
+        ev = {"id": r.get("id"), "at": at, "by": r.get("evaluator", ""), "state": r, "baseline": True}
+        groups.setdefault(partition_key_for_date(_safe_date(at[:10])), []).append(ev)
+    for pkey, events in groups.items():
+        _append_history(pkey, events)
+
+
+def _init_history() -> None:
+    # Lần đầu bật lịch sử: ghi mốc cho mọi phiếu đang lưu, để "trạng thái tại một ngày"
+    # gồm cả các phiếu chưa từng được sửa
+    try:
+        os.makedirs(HISTORY_DIR)
+    except FileExistsError:
+        return
+    write_baselines([r for pkey in list_partitions() for r in load_partition(pkey)])
+
+
+def _history_lines(rid: Any = None) -> Iterator[str]:
+    # Đọc tuần tự mọi quý; chỉ dùng khi người dùng mở lịch sử hoặc xem trạng thái theo ngày.
+    # Lọc theo id bằng tiền tố dòng để không phải parse các dòng của phiếu khác
+    prefix = None if rid is None else '{"id": ' + json.dumps(rid, ensure_ascii=False) + ","
+    for pkey in list_history_shards():
+        with open(_history_path(pkey), "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                if prefix is None or line.startswith(prefix):
+                    yield line
+
+
+def _iter_history(rid: Any = None) -> Iterator[Dict[str, Any]]:
+    for line in _history_lines(rid):
+        try:
+            yield json.loads(line)
+        except Exception:
+            continue
+
+
+def record_version(rid: Any, rev: int) -> Optional[Dict[str, Any]]:
+    # rev là thứ tự sự kiện của phiếu trong lịch sử (bắt đầu từ 1). Chỉ parse các dòng
+    # từ mốc đầy đủ gần nhất trước rev (tối đa CHECKPOINT_EVERY dòng) rồi áp tới rev
+    lines = list(_history_lines(rid))
+    if not 1 <= rev <= len(lines):
+        return None
+    chain: List[Dict[str, Any]] = []
+    for line in reversed(lines[:rev]):
+        try:
+            ev = json.loads(line)
+        except Exception:
+            continue
+        chain.append(ev)
+        if "state" in ev or ev.get("deleted"):
+            break
+    state: Optional[Dict[str, Any]] = None
+    for ev in reversed(chain):
+        state = _apply_event(state, ev)
+    return state
+
+
+def state_as_of(day: date) -> List[Dict[str, Any]]:
+    cutoff = f"{day.isoformat()}T23:59:59"
+    latest: Dict[Any, Optional[Dict[str, Any]]] = {}
+    as_of: Dict[Any, Optional[Dict[str, Any]]] = {}
+    for ev in _iter_history():
+        at = ev.get("at", "")
+        if ev.get("purge"):
+            latest.clear()
+            if at <= cutoff:
+                as_of.clear()
+            continue
+        rid = ev.get("id")
+        latest[rid] = _apply_event(latest.get(rid), ev)
+        if at <= cutoff:
+            as_of[rid] = latest[rid]
+    return [r for r in as_of.values() if r is not None]
+
+
+def revision_log(rid: Any) -> List[Dict[str, Any]]:
+    labels = {
+        "mode": "Loại phiếu",
+        "date": "Ngày",
+        "evaluator": "Người đánh giá",
+        "chuc_danh": "Chức danh",
+        "notes": "Ghi chú",
+    }
+    labels.update(criteria_label_map())
+    rows = []
+    state: Optional[Dict[str, Any]] = None
+    for n, ev in enumerate(_iter_history(rid), start=1):
+        before = state or {}
+        state = _apply_event(state, ev)
+        if ev.get("deleted"):
+            desc = "Xóa phiếu"
+        elif ev.get("baseline"):
+            desc = "Trạng thái ban đầu"
+        elif not before:
+            desc = "Tạo phiếu"
+        else:
+            after = state or {}
+            keys = [k for k in after if k not in ("id", "createdAt") and before.get(k) != after.get(k)]
+            keys += [k for k in before if k not in after]
+            desc = "; ".join(f"{labels.get(k, k)}: {before.get(k) or '-'} → {after.get(k) or '-'}" for k in keys)
+        rows.append({"Lần": n, "Thời điểm": ev.get("at", ""), "Người sửa": ev.get("by") or "-", "Thay đổi": desc})
+    return rows
+
+
+def history_version() -> Tuple[Tuple[str, int], ...]:
+    # Lịch sử chỉ được ghi thêm vào cuối file nên kích thước từng quý đủ làm phiên bản
+    return tuple((pkey, os.path.getsize(_history_path(pkey))) for pkey in list_history_shards())
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_revision_log(rid: Any, version: Tuple[Tuple[str, int], ...]) -> List[Dict[str, Any]]:
+    return revision_log(rid)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def cached_record_version(rid: Any, rev: int, version: Tuple[Tuple[str, int], ...]) -> Optional[Dict[str, Any]]:
+    return record_version(rid, rev)
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def cached_state_as_of(day: date, version: Tuple[Tuple[str, int], ...]) -> Tuple[int, pd.DataFrame]:
+    snapshot = state_as_of(day)
+    df = records_to_df(snapshot)
+    return len(snapshot), (df.drop(columns=["id"]) if not df.empty else df)
+
+
+def data_version(loaded: PartitionVersions) -> Tuple[Tuple[str, Tuple[int, int]], ...]:
+    # Các phiên giữ cùng phiên bản file của từng kỳ thì có cùng dữ liệu trong bộ nhớ
+    return tuple(sorted(loaded.items()))
+
+
+def clear_data() -> None:
+    for pkey in list_partitions():
+        save_partition(pkey, [])
+    if os.path.exists(SUMMARIES_PATH):
+        os.remove(SUMMARIES_PATH)
+    _write_json(DATA_PATH, [])
 
 
 def mode_label(mode: str) -> str:
@@ -146,15 +758,44 @@ def compute_stats(records: List[Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, in
     return by_section, by_type, totals
 
 
+def combine_stats(
+    stats: Tuple[Dict[str, Dict[str, int]], Dict[str, int], Dict[str, int]],
+    summaries: List[Dict[str, Any]],
+) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int], Dict[str, int], int]:
+    # Cộng số liệu tổng hợp của các kỳ đã niêm phong (chưa nạp) vào số liệu đang có
+    by_section = {k: dict(v) for k, v in stats[0].items()}
+    by_type = dict(stats[1])
+    totals = dict(stats[2])
+    count = 0
+    for s in summaries:
+        for section, values in s.get("by_section", {}).items():
+            target = by_section.setdefault(section, {"co": 0, "khong": 0, "na": 0})
+            for k, v in values.items():
+                target[k] = target.get(k, 0) + v
+        for k, v in s.get("by_type", {}).items():
+            by_type[k] = by_type.get(k, 0) + v
+        for k, v in s.get("totals", {}).items():
+            totals[k] = totals.get(k, 0) + v
+        count += s.get("count", 0)
+    return by_section, by_type, totals, count
+
+
 def filter_records(
     records: List[Dict[str, Any]],
     search: str,
     mode: str,
     criterion_key: str,
     result_value: str,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
 ) -> List[Dict[str, Any]]:
     out = records[:]
 
+    if date_from or date_to:
+        lo = date_from.isoformat() if date_from else ""
+        hi = date_to.isoformat() if date_to else "9999-12-31"
+        out = [r for r in out if lo <= record_day(r) <= hi]
+
     if mode:
         out = [r for r in out if r.get("mode") == mode]
 
@@ -224,17 +865,88 @@ def records_to_df(records: List[Dict[str, Any]]) -> pd.DataFrame:
     return df
 
 
-def upsert_record(records: List[Dict[str, Any]], rec: Dict[str, Any]) -> None:
-    rid = rec.get("id")
-    for i, r in enumerate(records):
-        if r.get("id") == rid:
-            records[i] = rec
+# Kết quả lọc: (số phiếu, DataFrame hiển thị không có cột id, nội dung CSV).
+# Không giữ các dict phiếu để cache không níu dữ liệu của phiên đã tính ra kết quả
+QueryResult = Tuple[int, pd.DataFrame, str]
+
+
+def _estimate_size(result: QueryResult) -> int:
+    _count, df, csv = result
+    size = sys.getsizeof(csv)
+    if not df.empty:
+        size += int(df.memory_usage(deep=True).sum())
+    return size
+
+
+class QueryCache:
+    """Cache LRU cho kết quả lọc, DataFrame và CSV, loại bỏ theo dung lượng bộ nhớ."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[QueryResult, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[QueryResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Tuple[Any, ...], result: QueryResult) -> None:
+        size = _estimate_size(result)
+        if size > self.max_bytes:
             return
-    records.append(rec)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _key, (_result, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+
+@st.cache_resource
+def query_cache() -> QueryCache:
+    return QueryCache(QUERY_CACHE_MAX_BYTES)
 
 
-def delete_record(records: List[Dict[str, Any]], rid: int) -> None:
-    records[:] = [r for r in records if r.get("id") != rid]
+def cached_filter(
+    version: Tuple[Any, ...],
+    records: List[Dict[str, Any]],
+    search: str,
+    mode: str,
+    criterion_key: str,
+    result_value: str,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+) -> QueryResult:
+    # Kết quả dùng chung giữa các phiên: không được sửa DataFrame trả về
+    cache = query_cache()
+    key = (version, (search or "").strip().lower(), mode, criterion_key, result_value, date_from, date_to)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+    filtered = filter_records(records, search, mode, criterion_key, result_value, date_from, date_to)
+    df = records_to_df(filtered)
+    if not df.empty:
+        df = df.drop(columns=["id"])
+    csv = df.to_csv(index=False, encoding="utf-8-sig") if not df.empty else ""
+    result = (len(filtered), df, csv)
+    cache.put(key, result)
+    return result
 
 
 def radio_yes_no(label: str, key: str, allow_na: bool = False) -> str:
@@ -268,8 +980,8 @@ def render_form_structured(
         st.caption(subtitle)
 
     edit_id = st.session_state.get(f"edit_id_{mode}")
-    records: List[Dict[str, Any]] = st.session_state.records
-    current = next((r for r in records if r.get("id") == edit_id), None) if edit_id else None
+    store: RecordStore = st.session_state.store
+    current = store.get(edit_id) if edit_id else None
 
     # Prefill widgets when entering edit mode
     prefill_key = f"__prefilled_{mode}"
@@ -341,7 +1053,7 @@ def render_form_structured(
             st.error("Vui lòng nhập đầy đủ: Người đánh giá và Chức danh.")
             return
 
-        rid = int(time.time() * 1000) if not current else int(current["id"])
+        rid = new_record_id() if not current else current["id"]
         rec = {
             "id": rid,
             "mode": mode,
@@ -352,8 +1064,10 @@ def render_form_structured(
             "createdAt": _now_iso() if not current else current.get("createdAt", _now_iso()),
         }
         rec.update(answers)
-        upsert_record(records, rec)
-        save_data(records)
+        append_revision(current, rec, rec["evaluator"])
+        touched = {partition_key(rec)} | ({partition_key(current)} if current else set())
+        store.upsert(rec)
+        save_data(store, st.session_state.partitions, touched)
         st.session_state[f"edit_id_{mode}"] = None
         st.session_state[prefill_key] = None
         st.success("Đã lưu thành công.")
@@ -465,10 +1179,10 @@ def main() -> None:
         unsafe_allow_html=True,
     )
 
-    if "records" not in st.session_state:
-        st.session_state.records = load_data()
+    if "store" not in st.session_state:
+        st.session_state.store, st.session_state.partitions = load_live_data()
 
-    records: List[Dict[str, Any]] = st.session_state.records
+    store: RecordStore = st.session_state.store
 
     tabs = st.tabs(
         [
@@ -616,14 +1330,15 @@ def main() -> None:
         )
 
     with tabs[4]:
-        eval_modes = {"tochuc", "ksnk", "duoc", "kehoach"}
-        eval_records = [r for r in records if r.get("mode") in eval_modes]
+        eval_records = store.eval_records()
+        loaded: PartitionVersions = st.session_state.partitions
+        sealed = [s for k, s in load_summaries().items() if k not in loaded]
+        by_section, by_type, totals, sealed_count = combine_stats(compute_stats(eval_records), sealed)
 
-        if not eval_records:
+        if not eval_records and not sealed_count:
             st.info("Chưa có phiếu đánh giá để thống kê.")
         else:
-            by_section, by_type, totals = compute_stats(eval_records)
-            total_records = len(eval_records)
+            total_records = len(eval_records) + sealed_count
             total_answered = totals["co"] + totals["khong"] + totals["na"]
             denom = totals["co"] + totals["khong"]
             ti_le_co = (totals["co"] / denom) * 100 if denom else 0.0
@@ -635,6 +1350,8 @@ def main() -> None:
             m2.metric("Tổng tiêu chí đã đánh giá", total_answered)
             m3.metric("Tỷ lệ “Có”", f"{ti_le_co:.1f}%")
             m4.metric("Phiếu hôm nay", today_records)
+            if sealed_count:
+                st.caption(f"Bao gồm {sealed_count} phiếu của các kỳ đã đóng (số liệu tổng hợp sẵn).")
 
             st.divider()
             st.subheader("Thống kê theo nhóm tiêu chuẩn (I–V)")
@@ -674,8 +1391,15 @@ def main() -> None:
 
     with tabs[5]:
         st.subheader("Dữ liệu")
-        eval_modes = {"tochuc", "ksnk", "duoc", "kehoach"}
-        eval_records = [r for r in records if r.get("mode") in eval_modes]
+        loaded = st.session_state.partitions
+        d1, d2, _ = st.columns([1, 1, 2])
+        with d1:
+            date_from = st.date_input("Từ ngày", value=partition_bounds(active_partition_key())[0])
+        with d2:
+            date_to = st.date_input("Đến ngày", value=partition_bounds(max(loaded))[1])
+        # Chỉ nạp các kỳ cũ khi người dùng lọc tới khoảng thời gian đó
+        ensure_partitions_loaded(store, loaded, partitions_in_range(date_from, date_to))
+        eval_records = store.eval_records()
 
         c1, c2, c3, c4 = st.columns([2, 1, 2, 1])
         with c1:
@@ -693,14 +1417,16 @@ def main() -> None:
         with c4:
             result = st.selectbox("Kết quả", ["", "Có", "Không", "Không áp dụng"], format_func=lambda x: "Tất cả" if x == "" else x)
 
-        filtered = filter_records(eval_records, search, mode, crit, result)
-        df = records_to_df(filtered)
+        count, df, csv = cached_filter(
+            data_version(loaded), eval_records, search, mode, crit, result, date_from, date_to
+        )
 
-        st.caption(f"Đang hiển thị: {len(filtered)} phiếu")
+        st.caption(f"Đang hiển thị: {count} phiếu")
+        if DEBUG:
+            st.caption(f"Cache truy vấn: {query_cache().stats()}")
 
         if not df.empty:
-            st.dataframe(df.drop(columns=["id"]), use_container_width=True, hide_index=True)
-            csv = df.drop(columns=["id"]).to_csv(index=False, encoding="utf-8-sig")
+            st.dataframe(df, use_container_width=True, hide_index=True)
             st.download_button(
                 "📥 Xuất CSV theo kết quả tìm kiếm",
                 data=csv,
@@ -715,10 +1441,14 @@ def main() -> None:
         if not eval_records:
             st.caption("Chưa có phiếu để sửa/xóa.")
         else:
-            id_to_label = {r["id"]: f"{mode_label(r['mode'])} | {get_chuc_danh(r) or '-'} | {r.get('date','-')} | ID {r['id']}" for r in eval_records}
-            selected_id = st.selectbox("Chọn phiếu", [""] + list(id_to_label.keys()), format_func=lambda x: "—" if x == "" else id_to_label[x])
+            id_to_label = store.labels()
+            pick_query = st.text_input("Tìm phiếu", placeholder="Loại phiếu / chức danh / ngày / ID...", key="pick_query")
+            matches = store.search_labels(pick_query, PICKER_LIMIT)
+            selected_id = st.selectbox("Chọn phiếu", [""] + matches, format_func=lambda x: "—" if x == "" else id_to_label[x])
+            if len(matches) >= PICKER_LIMIT:
+                st.caption(f"Chỉ hiển thị {PICKER_LIMIT} phiếu phù hợp đầu tiên, hãy gõ thêm để thu hẹp.")
             if selected_id:
-                rec = next((r for r in records if r.get("id") == selected_id), None)
+                rec = store.get(selected_id)
                 if rec:
                     b1, b2, b3 = st.columns([1, 1, 2])
                     with b1:
@@ -727,17 +1457,51 @@ def main() -> None:
                             st.success("Đã chuyển sang chế độ sửa. Hãy mở tab tương ứng để chỉnh.")
                     with b2:
                         if st.button("🗑️ Xóa"):
-                            delete_record(records, selected_id)
-                            save_data(records)
+                            append_deletion(rec)
+                            store.delete(selected_id)
+                            save_data(store, loaded, {partition_key(rec)})
                             st.success("Đã xóa phiếu.")
                             st.rerun()
                     with b3:
                         st.caption("Khi bấm Sửa, bạn qua đúng tab (Tổ chức/Chống NK/Dược/Kế hoạch) để chỉnh và bấm Lưu.")
+                    if st.checkbox("📜 Xem lịch sử chỉnh sửa"):
+                        hist_version = history_version()
+                        log = cached_revision_log(rec["id"], hist_version)
+                        if log:
+                            st.dataframe(pd.DataFrame(log), use_container_width=True, hide_index=True)
+                            rev = st.selectbox(
+                                "Xem nội dung phiếu tại lần",
+                                [row["Lần"] for row in log],
+                                index=len(log) - 1,
+                                key=f"rev_{rec['id']}",
+                            )
+                            version = cached_record_version(rec["id"], rev, hist_version)
+                            if version is None:
+                                st.caption("Phiếu đã bị xóa ở lần này.")
+                            else:
+                                row = record_to_row(version)
+                                row.pop("id", None)
+                                st.dataframe(
+                                    pd.DataFrame({"Trường": list(row.keys()), "Giá trị": list(row.values())}),
+                                    use_container_width=True,
+                                    hide_index=True,
+                                )
+                        else:
+                            st.caption("Phiếu chưa có lịch sử chỉnh sửa.")
+
+        if st.checkbox("🕓 Xem trạng thái các phiếu tại một ngày"):
+            as_of = st.date_input("Tại ngày", value=date.today(), key="as_of_date")
+            snapshot_count, snapshot_df = cached_state_as_of(as_of, history_version())
+            st.caption(f"{snapshot_count} phiếu.")
+            if snapshot_count:
+                st.dataframe(snapshot_df, use_container_width=True, hide_index=True)
 
         with st.expander("⚠️ Xóa tất cả dữ liệu"):
             if st.button("Xóa tất cả", type="secondary"):
-                st.session_state.records = []
-                save_data([])
+                append_purge()
+                clear_data()
+                st.session_state.store = RecordStore([])
+                st.session_state.partitions = {active_partition_key(): (0, 0)}
                 st.success("Đã xóa toàn bộ dữ liệu.")
                 st.rerun()
 